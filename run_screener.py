@@ -4,11 +4,31 @@
 from tradingview_screener import Query, Column
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import pytz
-import requests
-from requests.adapters import HTTPAdapter
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import sys
+import logging
+from typing import Any
+import operator
+from collections import Counter
+import asyncio
+import aiohttp
+import msgspec
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from diskcache import Cache
+
+# uvloop's libuv event loop cuts per-request overhead; it isn't available on Windows
+if sys.platform != 'win32':
+    import uvloop
+    _run_async = uvloop.run
+else:
+    _run_async = asyncio.run
+
+log = logging.getLogger(__name__)
 
 # ─── Configuration ───────────────────────────────────────────────────────────────
 
@@ -20,14 +40,72 @@ _QFS_FIELDS = [
     "ev_ebitda", "beta", "avg_vol_50d", "dividend_date",
     "ex_dividend_date", "description"
 ]
+_QFS_COLUMNS = [f"qfs_{f}" for f in _QFS_FIELDS + ["qfs_ticker"]]
+_GET_QFS_FIELDS = operator.itemgetter(*_QFS_FIELDS)
+
+# Typed decoder for the overview response: only the metadata fields above are
+# materialised, the rest of the payload is skipped while parsing
+_QFSMeta = msgspec.defstruct("_QFSMeta", [(f, Any, None) for f in _QFS_FIELDS])
+
+class _QFSDatasets(msgspec.Struct):
+    metadata: _QFSMeta
+
+class _QFSResponse(msgspec.Struct):
+    datasets: _QFSDatasets
+
+_QFS_DECODER = msgspec.json.Decoder(_QFSResponse)
+
+# Low-cardinality text columns, stored as categoricals to keep the frame small
+_TV_CATEGORY_COLS = ('exchange', 'sector', 'industry', 'type')
+_QFS_CATEGORY_COLS = (
+    'qfs_exchange', 'qfs_country', 'qfs_currency', 'qfs_sector', 'qfs_industry'
+)
 
 _QFS_HEADERS = {
     "Accept": "application/json",
     "User-Agent": "Mozilla/5.0"
 }
 
+# Re-runs are served from disk. Cached rows include price and valuation fields, so
+# entries live for an hour by default; set QFS_DEV_CACHE=1 to keep them for 6h while
+# iterating locally. Tickers QuickFS doesn't know (404) are remembered briefly so
+# re-runs don't hammer them; auth, blocking and timeout errors are never cached.
+_QFS_CACHE_DIR = ".qfs_cache"
+_QFS_DEV_CACHE = os.environ.get("QFS_DEV_CACHE", "").strip().lower() in {"1", "true", "yes"}
+_QFS_CACHE_TTL = (6 if _QFS_DEV_CACHE else 1) * 3600  # seconds
+_QFS_NEGATIVE_TTL = 15 * 60  # seconds
+_QFS_NEGATIVE_STATUSES = {404}
+
+# Throttling, transient server errors and dropped connections are retried with
+# exponential backoff, or after the server's Retry-After when it sends one
+_QFS_RETRIES = 3
+_QFS_BACKOFF = 0.3  # seconds, doubled on each attempt
+_QFS_MAX_RETRY_AFTER = 60  # seconds
+_QFS_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_CSV_BATCH_ROWS = 500
+
 # ─── Screener Query ─────────────────────────────────────────────────────────────
 
+def _fmt_epoch(values):
+    # Vectorised 'YYYY-MM-DD HH:MM:SS' formatting of epoch seconds; missing -> NaN
+    secs = pd.to_numeric(values, errors='coerce').to_numpy(dtype='float64')
+    if secs.size == 0:  # np.char.replace can't handle zero-length arrays
+        return np.array([], dtype=object)
+    missing = ~np.isfinite(secs)
+    stamps = np.where(missing, 0, secs).astype('int64').astype('datetime64[s]')
+    out = np.char.replace(np.datetime_as_string(stamps, unit='s'), 'T', ' ').astype(object)
+    out[missing] = np.nan
+    return out
+
+def _as_category(df, cols):
+    # Values are normalised to text first: QuickFS fields aren't type-checked, and
+    # Arrow rejects a categorical whose categories mix strings and numbers
+    for col in cols:
+        if col in df:
+            vals = df[col]
+            df[col] = vals.where(vals.isna(), vals.astype(str)).astype('category')
+
 def fetch_tradingview():
     result = (
         Query()
@@ -38,7 +116,7 @@ def fetch_tradingview():
             'earnings_release_date', 'earnings_release_next_date',
             'eps_surprise_fq', 'revenue_surprise_percent_fq',
             'recommendation_total', 'recommendation_buy',
-            'recommendation_mark', 'price_target_1y', 'typespecs',
+            'recommendation_mark', 'price_target_1y',
             'Perf.1M', 'Perf.3M', 'Perf.6M', 'Perf.Y', 'Perf.W'
         )
         .where(
@@ -52,96 +130,164 @@ def fetch_tradingview():
     )
 
     df = result[1]
-    df = df.applymap(lambda x: str(x) if isinstance(x, (list, dict)) else x)
-    df['earnings_release_date'] = (
-        pd.to_datetime(df['earnings_release_date'], unit='s')
-          .dt.strftime('%Y-%m-%d %H:%M:%S')
-    )
-    df['earnings_release_next_date'] = (
-        pd.to_datetime(df['earnings_release_next_date'], unit='s')
-          .dt.strftime('%Y-%m-%d %H:%M:%S')
-    )
-    df = df.replace([np.inf, -np.inf], np.nan).fillna('')
+    # Only object columns can hold lists/dicts; 'indexes' is flattened separately below
+    for col in df.select_dtypes(include='object').columns.drop('indexes', errors='ignore'):
+        df[col] = [str(v) if isinstance(v, (list, dict)) else v for v in df[col].to_numpy()]
+    for col in ('earnings_release_date', 'earnings_release_next_date'):
+        df[col] = _fmt_epoch(df[col])
 
-    def extract_index_names(val):
-        if isinstance(val, list):
-            return ', '.join(item.get('name', '') for item in val)
-        if isinstance(val, dict):
-            return val.get('name', '')
-        try:
-            parsed = pd.io.json.loads(val)
-            if isinstance(parsed, list):
-                return ', '.join(i.get('name', '') for i in parsed)
-            if isinstance(parsed, dict):
-                return parsed.get('name', '')
-        except Exception:
-            pass
-        return ''
-
-    df['indexes'] = df['indexes'].apply(extract_index_names)
+    # TradingView returns 'indexes' as a list of {'name': ..., 'proname': ...} dicts
+    df['indexes'] = [
+        ', '.join(i.get('name', '') for i in v) if isinstance(v, list)
+        else v.get('name', '') if isinstance(v, dict)
+        else ''
+        for v in df['indexes'].to_numpy()
+    ]
     now = datetime.now(LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S')
     df.insert(0, 'retrieval_time', now)
+    _as_category(df, _TV_CATEGORY_COLS)
     return df
 
 # ─── QuickFS Metadata Fetch ────────────────────────────────────────────────────
 
+def _retry_after(value, default):
+    # Retry-After is either delta-seconds or an HTTP date
+    if value is None:
+        return default
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return default
+    return min(max(delay, 0), _QFS_MAX_RETRY_AFTER)
+
 def fetch_all_with_us(df, symbol_col="symbol", country_col=None, max_workers=30):
     if country_col and country_col in df.columns:
-        pairs = list(df[[symbol_col, country_col]].itertuples(index=False, name=None))
+        pairs = list(zip(df[symbol_col].to_numpy(), df[country_col].to_numpy()))
     else:
         pairs = [(sym, "US") for sym in df[symbol_col]]
 
-    session = requests.Session()
-    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
-    session.mount("https://", adapter)
-    session.mount("http://", adapter)
+    failures = Counter()  # failed lookups by HTTP status or exception type
 
-    def _fetch_meta(sym, ctry):
+    async def _fetch_meta(session, sem, cache, sym, ctry):
         tk = f"{sym}:{ctry}"
+        meta = cache.get(tk)
+        if isinstance(meta, int):  # cached rejection, holds the HTTP status
+            failures[meta] += 1
+            return (None,) * len(_QFS_FIELDS) + (tk,)
+        if meta is not None:
+            try:
+                return _GET_QFS_FIELDS(meta) + (tk,)
+            except KeyError:
+                pass  # entry is missing a field we now keep; refetch it
+
         url = f"https://api.quickfs.net/stocks/{tk}/ovr/Quarter/"
         try:
-            r = session.get(url, headers=_QFS_HEADERS, timeout=10)
-            r.raise_for_status()
-            meta = r.json()["datasets"]["metadata"]
-            out = {f: meta.get(f) for f in _QFS_FIELDS}
+            for attempt in range(_QFS_RETRIES + 1):
+                delay = _QFS_BACKOFF * 2 ** attempt
+                try:
+                    async with sem, session.get(url) as r:
+                        if r.status not in _QFS_RETRY_STATUSES or attempt == _QFS_RETRIES:
+                            r.raise_for_status()
+                            resp = _QFS_DECODER.decode(await r.read())
+                            break
+                        delay = _retry_after(r.headers.get("Retry-After"), delay)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == _QFS_RETRIES:
+                        raise
+                await asyncio.sleep(delay)
+            vals = msgspec.structs.astuple(resp.datasets.metadata)
+            cache.set(tk, dict(zip(_QFS_FIELDS, vals)), expire=_QFS_CACHE_TTL)
         except Exception as e:
-            print(f"⚠️ Failed {tk}: {e}")
-            out = {f: None for f in _QFS_FIELDS}
-        out["qfs_ticker"] = tk
-        return out
-
-    results = [None] * len(pairs)
-    with ThreadPoolExecutor(max_workers=max_workers) as pool:
-        futures = {
-            pool.submit(_fetch_meta, sym, ctry): idx
-            for idx, (sym, ctry) in enumerate(pairs)
-        }
-        for fut in as_completed(futures):
-            results[futures[fut]] = fut.result()
-
-    meta_df = pd.DataFrame(results).rename(columns=lambda c: f"qfs_{c}")
-    for col in ("qfs_dividend_date", "qfs_ex_dividend_date"):
-        if col in meta_df:
-            meta_df[col] = (
-                pd.to_datetime(meta_df[col], format="%Y%m%d", errors="coerce")
-                  .dt.strftime("%Y-%m-%d")
-            )
-    return pd.concat([df.reset_index(drop=True), meta_df], axis=1)
+            log.debug("QuickFS fetch failed for %s: %s", tk, e)
+            status = getattr(e, "status", None)
+            if status in _QFS_NEGATIVE_STATUSES:
+                cache.set(tk, status, expire=_QFS_NEGATIVE_TTL)
+            failures[status or type(e).__name__] += 1
+            vals = (None,) * len(_QFS_FIELDS)
+        return vals + (tk,)
+
+    async def _gather(pairs, cache):
+        results = [None] * len(pairs)
+        sem = asyncio.Semaphore(max_workers)
+        connector = aiohttp.TCPConnector(limit=max_workers, limit_per_host=max_workers)
+        timeout = aiohttp.ClientTimeout(total=10)
+
+        async with aiohttp.ClientSession(
+            connector=connector, headers=_QFS_HEADERS, timeout=timeout
+        ) as session:
+            async def _fetch_into(idx, sym, ctry):
+                results[idx] = await _fetch_meta(session, sem, cache, sym, ctry)
+
+            await asyncio.gather(*(
+                _fetch_into(idx, sym, ctry)
+                for idx, (sym, ctry) in enumerate(pairs)
+            ))
+        return results
+
+    # Repeated (symbol, country) pairs are fetched once and fanned back out by row
+    unique = {}
+    row_keys = [unique.setdefault(pair, len(unique)) for pair in pairs]
+    with Cache(_QFS_CACHE_DIR) as cache:
+        fetched = _run_async(_gather(list(unique), cache))
+    results = [fetched[k] for k in row_keys]
+    if failures:
+        summary = ", ".join(f"{reason}: {n}" for reason, n in failures.most_common())
+        print(f"⚠️ QuickFS lookup failed for {failures.total()} of {len(unique)} tickers ({summary})")
+
+    meta_df = pd.DataFrame(results, columns=_QFS_COLUMNS)
+
+    # QuickFS dates are YYYYMMDD; stack both columns so Arrow parses and
+    # formats them in a single kernel call, unparseable values become null
+    date_cols = ("qfs_dividend_date", "qfs_ex_dividend_date")
+    n = len(meta_df)
+    raw = pd.concat([pd.to_numeric(meta_df[c], errors="coerce") for c in date_cols])
+    ymd = pa.array(raw, from_pandas=True).cast(pa.int64(), safe=False).cast(pa.string())
+    dates = pc.strftime(
+        pc.strptime(ymd, format="%Y%m%d", unit="s", error_is_null=True),
+        format="%Y-%m-%d",
+    )
+    for i, col in enumerate(date_cols):
+        meta_df[col] = dates.slice(i * n, n).to_numpy(zero_copy_only=False)
+    _as_category(meta_df, _QFS_CATEGORY_COLS)
+
+    # meta_df rows follow df's row order, so attach its columns in place
+    # rather than concatenating into a fresh frame
+    df = df.reset_index(drop=True)
+    for col in meta_df.columns:
+        df[col] = meta_df[col].array
+    return df
 
 # ─── Main ──────────────────────────────────────────────────────────────────────
 
 def main():
-    df = fetch_tradingview()
-    df2 = fetch_all_with_us(df, symbol_col="name")
-    df2 = df2.replace([np.inf, -np.inf], np.nan).fillna('')
+    # The screener frame is only needed until its QuickFS columns are attached
+    df2 = fetch_all_with_us(fetch_tradingview(), symbol_col="name")
+    df2.replace([np.inf, -np.inf], np.nan, inplace=True)
 
     # — SAVE TO CSV FOR GITHUB —──────────────────────────────────────────────────
+    # Arrow writes nulls as empty fields, so no fillna('') pass is needed; object
+    # columns are cast to text so mixed str/number values can't break the schema.
+    # Rows are streamed out in fixed-size batches rather than converting the
+    # whole frame into one Arrow table.
     output_file = 'screener_results.csv'
-    df2.to_csv(output_file, index=False)
+    obj_cols = df2.select_dtypes(include='object').columns
+    csv_df = df2.astype({c: 'string' for c in obj_cols})
+    schema = pa.Schema.from_pandas(csv_df, preserve_index=False)
+    with pacsv.CSVWriter(output_file, schema) as writer:
+        for start in range(0, len(csv_df), _CSV_BATCH_ROWS):
+            chunk = csv_df.iloc[start:start + _CSV_BATCH_ROWS]
+            writer.write_batch(
+                pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
     print(f"✅ Saved screener results to {output_file}")
 
     # Print a preview
-    print(df2.head().to_string(index=False))
+    # na_rep doesn't cover None in object columns, so blank every null explicitly
+    head = df2.head()
+    print(head.astype(object).where(head.notna(), '').to_string(index=False))
 
 if __name__ == "__main__":
     main()